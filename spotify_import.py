@@ -2,24 +2,39 @@
 
 import argparse
 import csv
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from difflib import SequenceMatcher
-from typing import List
+from functools import cached_property
+from itertools import islice, tee
+from operator import itemgetter
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import orjson
+import requests
 import spotipy
 from dotenv import load_dotenv
-from spotipy import SpotifyOAuth
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from spotipy import SpotifyException, SpotifyOAuth
+from urllib3.exceptions import NewConnectionError
 
+logger = logging.getLogger('spotify_import')
 
-def dict_get(adict: dict, *keys: str):
-    current = adict
+SEARCH_CACHE_FILE = '.search_cache.json'
+
+
+def dict_get(adict: Optional[dict], *keys: str, _get=dict.get) -> Any:
     if not keys:
         return None
+    current: Any = adict
     for key in keys:
-        if current and key in current:
-            current = current.get(key, None)
-        else:
-            current = None
+        if not isinstance(current, dict):
+            return None
+        current = _get(current, key)
     return current
 
 
@@ -28,160 +43,387 @@ class SpotifyImportException(Exception):
     pass
 
 
-def scoped(scopes: List[str]):
+class RateLimiter:
+    """Leaky-bucket limiter capping both the request rate and the number of requests in flight."""
+
+    def __init__(self, rps: float, concurrency: int):
+        self.sem = threading.Semaphore(concurrency)
+        self.interval = 1.0 / rps
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self.sem.acquire()
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self._next - now)
+            self._next = max(now, self._next) + self.interval
+        time.sleep(delay)
+
+    def release(self):
+        self.sem.release()
+
+    def backoff(self, seconds: float):
+        """Hold off every request for at least the given number of seconds, e.g. after a 429."""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def scoped(scopes: List[str]) -> str:
     return ' '.join(scopes)
 
 
-def replace_bad_words(song: str):
-    bad_words = ('feat. ', 'ft. ', ' (Original Mix)', ' (Original mix)', ' (original mix)', ' - Original Mix', ' &')
-    for word in bad_words:
-        song = song.replace(word, '')
-    return song
+BAD_WORDS = ('feat. ', 'ft. ', ' (Original Mix)', ' (Original mix)', ' (original mix)', ' - Original Mix', ' &')
+_BAD_WORDS_RE = re.compile('|'.join(map(re.escape, BAD_WORDS)))
+
+
+def replace_bad_words(song: str) -> str:
+    return _BAD_WORDS_RE.sub('', song)
 
 
-def divide_tracks_into_chunks(tracks):
+def divide_tracks_into_chunks(tracks: Iterable[str]) -> Iterator[List[str]]:
     per_request_track_threshold = 100
-    track_sub_lists = [tracks[i:i + per_request_track_threshold] for i in
-                       range(0, len(tracks), per_request_track_threshold)]
-    return track_sub_lists
+    tracks = iter(tracks)
+    while chunk := list(islice(tracks, per_request_track_threshold)):
+        yield chunk
+
+
+def track_candidate(track: dict) -> Tuple[str, str, str, str]:
+    """Return the (id, artists, title, album) of a track from a search result."""
+    return (track['id'], ', '.join(artist['name'] for artist in track['artists']), track['name'],
+            track['album']['name'])
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.casefold().split())
+
+
+def parse_retry_after(headers: Optional[dict]) -> Optional[float]:
+    """Return the Retry-After header in seconds, or None if it is missing or not a number of seconds."""
+    try:
+        return max(0.0, float((headers or {})['Retry-After']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_search_cache_entry(entry: Any) -> bool:
+    """Whether entry is a [searched at, [[id, artists, title, album], ...]] search cache entry."""
+    return (isinstance(entry, list) and len(entry) == 2 and isinstance(entry[0], (int, float))
+            and isinstance(entry[1], list)
+            and all(isinstance(candidate, list) and len(candidate) == 4 for candidate in entry[1]))
+
+
+def is_connect_error(error: requests.RequestException) -> bool:
+    """Whether the request failed while connecting, i.e. before Spotify could have received it."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def load_json(path: str) -> Any:
+    try:
+        with open(path, 'rb') as json_file:
+            return orjson.loads(json_file.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def best_match(query: str, candidates: List[Tuple[str, str, str, str]], with_album: bool = True,
+               score_cutoff: float = 50) -> Optional[str]:
+    """Return the id of the (id, artists, title, album) candidate that best matches query, or None if none is close.
+
+    Candidates are compared as 'artists - title - album', or 'artists - title' when the query has no album.
+    """
+    names = [' - '.join((artists, title, album) if with_album else (artists, title))
+             for _, artists, title, album in candidates]
+    match = process.extractOne(query, names, scorer=fuzz.token_sort_ratio, processor=default_process,
+                               score_cutoff=score_cutoff)
+    return candidates[match[2]][0] if match else None
 
 
 class SpotifyImport:
     PLAYLIST_ADD_TRACK_LIMIT = 100
     LIBRARY_ADD_TRACK_LIMIT = 50
-
-    def __init__(self, destination, songs, playlist=None):
+    MAX_REQUESTS_PER_SECOND = 10
+    MAX_CONCURRENT_REQUESTS = 2
+    MAX_ATTEMPTS = 5
+    MAX_BACKOFF = 30
+    SEARCH_BATCH_SIZE = 20
+    SEARCH_CACHE_TTL = 604800  # one week, in seconds
+
+    def __init__(self, destination, songs, playlist=None, use_cache=True, sp=None):
         self.destination = destination
         self.songs = songs
         if destination == 'playlist':
             self.playlist = playlist if playlist else f'Imported Playlist on {datetime.now().isoformat()}'
 
-        load_dotenv()
-        scope = scoped(['playlist-modify-private', 'user-library-modify'])
-        self.sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope, open_browser=False))
-
-    def _get_user_id(self):
+        if sp is None:
+            load_dotenv()
+            scope = scoped(['playlist-modify-private', 'user-library-modify'])
+            # A plain session without spotipy's urllib3 retries, so that _call sees every 429/5xx and its headers.
+            sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope=scope, open_browser=False),
+                                 requests_session=requests.Session(), retries=0, status_retries=0)
+        self.sp = sp
+        self.limiter = RateLimiter(self.MAX_REQUESTS_PER_SECOND, self.MAX_CONCURRENT_REQUESTS)
+        self.use_cache = use_cache
+        self._search_cache = self._load_search_cache() if use_cache else {}
+
+    @cached_property
+    def user_id(self) -> str:
         return self.sp.me()['id']
 
+    @cached_property
+    def created_playlist(self) -> dict:
+        """The playlist that imported tracks are saved to, created on first use."""
+        return self._call(self.sp.user_playlist_create, user=self.user_id, name=self.playlist, public=False,
+                          idempotent=False)
+
+    @property
+    def save_batch_size(self) -> int:
+        """How many tracks to collect before saving them, the most a single add request to the destination takes."""
+        return self.PLAYLIST_ADD_TRACK_LIMIT if self.destination == 'playlist' else self.LIBRARY_ADD_TRACK_LIMIT
+
+    def _call(self, func, *args, idempotent=True, **kwargs):
+        """Call a spotipy method through the rate limiter, retrying 429s, 5xxs and connection errors with backoff.
+
+        Calls that are not idempotent, like creating a playlist or adding tracks to one, may already have been
+        applied when a 5xx or read timeout comes back, so those are only retried on 429s and connect errors.
+        """
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                with self.limiter:
+                    return func(*args, **kwargs)
+            except SpotifyException as e:
+                retryable = e.http_status == 429 or (idempotent and e.http_status >= 500)
+                if not retryable or attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+                error = f'HTTP {e.http_status}'
+                throttled = e.http_status == 429
+                retry_after = parse_retry_after(e.headers)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not (idempotent or is_connect_error(e)) or attempt == self.MAX_ATTEMPTS - 1:
+                    raise
+                error = type(e).__name__
+                throttled = False
+                retry_after = None
+            delay = retry_after if retry_after is not None else min(self.MAX_BACKOFF, 2 ** attempt)
+            logger.debug(f'Got {error}, retrying in {delay}s')
+            if throttled:
+                self.limiter.backoff(delay)
+            else:
+                time.sleep(delay)
+
+    def _safe_search(self, query: str, limit: int) -> Optional[dict]:
+        try:
+            return self._call(self.sp.search, query, limit=limit)
+        except (SpotifyException, requests.ConnectionError, requests.Timeout) as e:
+            logger.warning(f'Search for {query!r} failed: {e}')
+            return None
+
+    def _search_many(self, queries: Iterable[str], limit: int = 10):
+        """Search for each query concurrently, yielding (query, candidates) pairs in the same order as queries.
+
+        Each candidate is an (id, artists, title, album) tuple. Queries are consumed lazily in batches, and queries
+        already in the search cache, including repeats within the same file, are not searched again. Empty queries
+        are never searched and yield no candidates. Cache entries are (searched at, candidates) pairs. Searches that
+        keep failing yield no candidates and are left out of the cache so that the next run tries them again.
+        """
+        queries = iter(queries)
+        with ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_REQUESTS) as executor:
+            while batch := list(islice(queries, self.SEARCH_BATCH_SIZE)):
+                keys = [f'{limit}:{normalize_query(query)}' for query in batch]
+                pending: Dict[str, str] = {}
+                for key, query in zip(keys, batch):
+                    if query and key not in self._search_cache:
+                        pending.setdefault(key, query)
+                results = executor.map(lambda query: self._safe_search(query, limit), pending.values())
+                for key, result in zip(pending, results):
+                    if result is None:
+                        continue
+                    track_items = dict_get(result, 'tracks', 'items') or []
+                    candidates = [track_candidate(item) for item in track_items]
+                    self._search_cache[key] = (time.time(), candidates)
+                for query, key in zip(batch, keys):
+                    _, candidates = self._search_cache.get(key, (None, []))
+                    yield query, candidates
+
+    def _load_search_cache(self) -> dict:
+        """Load the search cache from disk, dropping malformed entries and those older than SEARCH_CACHE_TTL."""
+        expires_before = time.time() - self.SEARCH_CACHE_TTL
+        search_cache = load_json(SEARCH_CACHE_FILE)
+        if not isinstance(search_cache, dict):
+            return {}
+        return {key: entry for key, entry in search_cache.items()
+                if is_search_cache_entry(entry) and entry[0] > expires_before}
+
+    def _save_search_cache(self):
+        with open(SEARCH_CACHE_FILE, 'wb') as cache_file:
+            cache_file.write(orjson.dumps(self._search_cache))
+
     def _save_tracks_to_playlist(self, playlist, tracks):
         tracks_list = divide_tracks_into_chunks(tracks)
         for tracks in tracks_list:
-            self.sp.playlist_add_items(playlist['id'], tracks)
-            print(f'Added {len(tracks)} tracks to playlist')
+            self._call(self.sp.playlist_add_items, playlist['id'], tracks, idempotent=False)
+            logger.info(f'Added {len(tracks)} tracks to playlist')
 
     def _save_tracks_to_library(self, tracks):
         tracks_list = divide_tracks_into_chunks(tracks)
         for tracks in tracks_list:
-            self.sp.current_user_saved_tracks_add(tracks)
-            print(f'Added {len(tracks)} tracks to library')
+            self._call(self.sp.current_user_saved_tracks_add, tracks)
+            logger.info(f'Added {len(tracks)} tracks to library')
 
     def _save_tracks(self, tracks: List[str], failed_count: int):
         if self.destination == 'playlist':
-            playlist = self.sp.user_playlist_create(user=self._get_user_id(), name=self.playlist, public=False)
-            self.sp.playlist_add_items(playlist['id'], tracks)
+            self._save_tracks_to_playlist(self.created_playlist, tracks)
         else:
             self._save_tracks_to_library(tracks)
-        print(f'Saved a total of {len(tracks)} tracks to {self.destination}, '
-              f'failed to add {failed_count} songs (see failed.txt)')
+        logger.info(f'Saved a total of {len(tracks)} tracks to {self.destination}, '
+                    f'failed to add {failed_count} songs (see failed.txt)')
+
+    @staticmethod
+    def _txt_queries(lines: Iterable[str]) -> Iterator[str]:
+        for line in lines:
+            song = replace_bad_words(line.strip())
+            if song:
+                yield song
 
     def _run_txt(self):
-        with open(self.songs) as songs_file, open('failed.txt', 'w') as failed_file:
+        with open(self.songs) as songs_file, open('failed.txt', 'w', buffering=1 << 16) as failed_file:
             tracks = []
+            seen = set()
             failed_count = 0
-
-            for song in (line.strip() for line in songs_file):
-                song = replace_bad_words(song)
-
-                if not song:
-                    continue
-
-                result = self.sp.search(song, limit=1)
-                track_items = dict_get(result, 'tracks', 'items')
-                track_id = track_items[0].get('id') if track_items else None
-                if track_id:
+            duplicate_count = 0
+
+            for song, candidates in self._search_many(self._txt_queries(songs_file), limit=1):
+                track_id = candidates[0][0] if candidates else None
+                if track_id in seen:
+                    duplicate_count += 1
+                elif track_id:
+                    seen.add(track_id)
                     tracks.append(track_id)
                 else:
                     failed_count += 1
-                    print(f"Couldn't find anything for {song!r}: {result!r}")
+                    logger.debug(f"Couldn't find anything for {song!r}")
                     print(song, file=failed_file)
 
-                if len(tracks) == self.PLAYLIST_ADD_TRACK_LIMIT:
+                if len(tracks) == self.save_batch_size:
                     self._save_tracks(tracks, failed_count)
                     tracks = []
 
             if tracks:
                 self._save_tracks(tracks, failed_count)
 
-        print('Done!')
+            if duplicate_count:
+                logger.info(f'Skipped {duplicate_count} duplicate tracks')
+
+        logger.info('Done!')
+
+    @staticmethod
+    def _csv_queries(rows: Iterator[List[str]], fieldnames: List[str]) -> Iterator[Tuple[str, bool, str]]:
+        """Yield a (query, has album, malformed row) triple for each row.
+
+        Rows too short to have a title and artist get an empty query, which is not searched, along with the row
+        itself so that it can be reported as failed.
+        """
+        title_index = fieldnames.index('title')
+        artist_index = fieldnames.index('artist')
+        album_index = fieldnames.index('album') if 'album' in fieldnames else None
+        for row in rows:
+            if not row:
+                continue
+            if len(row) <= max(title_index, artist_index):
+                yield '', False, ','.join(row)
+                continue
+            title = row[title_index]
+            artist = row[artist_index]
+            album = row[album_index] if album_index is not None and album_index < len(row) else None
+
+            if album:
+                query = ' - '.join((artist, title, album))
+            else:
+                query = ' - '.join((artist, title))
+            yield replace_bad_words(query), bool(album), ''
 
     def _run_csv(self):
-        with open(self.songs) as songs_csv, open('failed.txt', 'w') as failed_file:
+        with open(self.songs) as songs_csv, open('failed.txt', 'w', buffering=1 << 16) as failed_file:
             tracks = []
+            seen = set()
             failed_count = 0
+            duplicate_count = 0
 
             required_fields = ('title', 'artist')
-            datareader = csv.DictReader(songs_csv)
-            if not all(field in datareader.fieldnames for field in required_fields):
+            datareader = csv.reader(songs_csv)
+            fieldnames = next(datareader, [])
+            if not all(field in fieldnames for field in required_fields):
                 raise SpotifyImportException(
                     f"Some of the required fields {required_fields!r} missing from {self.songs!r}")
-            for row in datareader:
-                title = row['title']
-                artist = row['artist']
-                album = row.get('album', None)
 
-                if album:
-                    query = ' - '.join((artist, title, album))
-                else:
-                    query = ' - '.join((artist, title))
-                query = replace_bad_words(query)
-                result = self.sp.search(query)
-                track_items = dict_get(result, 'tracks', 'items')
-                if not track_items:
+            rows, search_rows = tee(self._csv_queries(datareader, fieldnames))
+            results = self._search_many(map(itemgetter(0), search_rows))
+            for (query, has_album, malformed_row), (_, candidates) in zip(rows, results):
+                if malformed_row:
                     failed_count += 1
-                    print(f"Failed {query!r}")
-                    print(query, file=failed_file)
+                    logger.debug(f"Missing title or artist in row {malformed_row!r}")
+                    print(malformed_row, file=failed_file)
                     continue
 
-                track_ids_and_names = [(item['id'], ' - '.join((', '.join(artist['name'] for artist in item['artists']),
-                                                                item['name'],
-                                                                item['album']['name'])))
-                                       for item in track_items]
-                track_ids_and_names.sort(key=lambda x: SequenceMatcher(None, query, x[1]).ratio(), reverse=True)
-                track_id = track_ids_and_names[0][0]
+                track_id = best_match(query, candidates, with_album=has_album)
+                if not track_id:
+                    failed_count += 1
+                    logger.debug(f"Failed {query!r}")
+                    print(query, file=failed_file)
+                    continue
 
+                if track_id in seen:
+                    duplicate_count += 1
+                    continue
+                seen.add(track_id)
                 tracks.append(track_id)
 
-                if len(tracks) == self.LIBRARY_ADD_TRACK_LIMIT:
+                if len(tracks) == self.save_batch_size:
                     self._save_tracks(tracks, failed_count)
                     tracks = []
 
             if tracks:
                 self._save_tracks(tracks, failed_count)
 
-            print('Done!')
+            if duplicate_count:
+                logger.info(f'Skipped {duplicate_count} duplicate tracks')
+
+            logger.info('Done!')
 
     def _search_user_playlist_by_name(self, name_to_search):
+        """Return the first of the user's playlists with the given name, or None, fetching all pages concurrently."""
         batch_size = 50
-        offset = 0
-        playlist = None
-        while True:
-            response = self.sp.current_user_playlists(limit=batch_size, offset=offset)
-            if not response['next'] or not response['items']:
-                break
-            playlists = response['items']
-            playlist = [p for p in playlists if p['name'] == name_to_search]
-            playlist = playlist[0] if playlist else None
-            offset += batch_size
-        return playlist
+        first_page = self._call(self.sp.current_user_playlists, limit=batch_size, offset=0)
+        offsets = range(batch_size, first_page['total'], batch_size)
+        with ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_REQUESTS) as executor:
+            pages = [first_page, *executor.map(
+                lambda offset: self._call(self.sp.current_user_playlists, limit=batch_size, offset=offset), offsets)]
+        return next((p for page in pages for p in page['items'] if p['name'] == name_to_search), None)
 
     def run(self):
         if self.songs.endswith('.txt'):
-            self._run_txt()
+            run_songs = self._run_txt
         elif self.songs.endswith('.csv'):
-            self._run_csv()
+            run_songs = self._run_csv
         else:
             raise SpotifyImportException("songs file must be either .txt or .csv")
 
+        try:
+            run_songs()
+        finally:
+            if self.use_cache:
+                self._save_search_cache()
+
     def _experiment(self):
         def artistify(track):
             return ', '.join(artist['name'] for artist in track['artists'])
@@ -195,7 +437,7 @@ class SpotifyImport:
 
         batch_size = 50
         print("Hello world")
-        print(self._get_user_id())
+        print(self.user_id)
         playlist = self._search_user_playlist_by_name('Playlist name here')
         offset = 0
         trigger_words = ['mixed', 'radio mix', 'radio edit', 'club edit', 'edit']
@@ -246,10 +488,24 @@ class SpotifyImport:
         pass
 
 
+def configure_logging(verbose: bool):
+    """Log this module's messages, at DEBUG when verbose, while keeping other libraries' debug output quiet.
+
+    spotipy logs request headers, including the OAuth token, at DEBUG, and logs every HTTP error at ERROR,
+    even those _call goes on to retry successfully, so its logger is silenced entirely.
+    """
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    logging.getLogger('spotipy').setLevel(logging.CRITICAL)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Simple CLI utility to import songs into a Spotify library or playlist')
     parser.add_argument('songs', help='path to your songs.txt or songs.csv file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every song that could not be found')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'neither read nor update the search results cache ({SEARCH_CACHE_FILE})')
 
     subparsers = parser.add_subparsers(metavar='destination', dest='destination', required=True,
                                        help='where to save the songs, one of: library, playlist')
@@ -259,9 +515,10 @@ def main():
     parser_dest.add_argument('playlist', help='playlist name', default=None)
 
     args = parser.parse_args()
+    configure_logging(args.verbose)
 
     playlist = getattr(args, 'playlist', None)
-    spotify_import = SpotifyImport(args.destination, args.songs, playlist)
+    spotify_import = SpotifyImport(args.destination, args.songs, playlist, use_cache=not args.no_cache)
     spotify_import.run()
 
 
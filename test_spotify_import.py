@@ -1,4 +1,16 @@
-from spotify_import import replace_bad_words, dict_get, scoped, divide_tracks_into_chunks
+import itertools
+import logging
+import threading
+import time
+
+import orjson
+import pytest
+import requests
+from spotipy import SpotifyException
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from spotify_import import replace_bad_words, dict_get, scoped, divide_tracks_into_chunks, best_match, RateLimiter, \
+    SpotifyImport, SEARCH_CACHE_FILE, configure_logging
 
 
 def test_replace_bad_words():
@@ -46,11 +58,287 @@ def test_dict_get():
 
 def test_divide_tracks_into_chunks():
     tracks = list(range(200))
-    assert divide_tracks_into_chunks(tracks) == [list(range(100)), list(range(100, 200))]
+    assert list(divide_tracks_into_chunks(tracks)) == [list(range(100)), list(range(100, 200))]
     tracks = list(range(199))
-    assert divide_tracks_into_chunks(tracks) == [list(range(100)), list(range(100, 199))]
+    assert list(divide_tracks_into_chunks(tracks)) == [list(range(100)), list(range(100, 199))]
     tracks = list(range(99))
-    assert divide_tracks_into_chunks(tracks) == [list(range(99))]
+    assert list(divide_tracks_into_chunks(tracks)) == [list(range(99))]
     tracks = list(range(299))
-    assert divide_tracks_into_chunks(tracks) == [list(range(100)), list(range(100, 200)), list(range(200, 299))]
+    assert list(divide_tracks_into_chunks(tracks)) == [list(range(100)), list(range(100, 200)),
+                                                       list(range(200, 299))]
+    assert list(divide_tracks_into_chunks([])) == []
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rps=50, concurrency=2)
+    start = time.monotonic()
+    for _ in range(6):
+        with limiter:
+            pass
+    assert time.monotonic() - start >= 5 * 0.02
+
+    limiter = RateLimiter(rps=1000, concurrency=2)
+    in_flight, max_in_flight = [0], [0]
+    counter_lock = threading.Lock()
+
+    def request():
+        with limiter:
+            with counter_lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            time.sleep(0.01)
+            with counter_lock:
+                in_flight[0] -= 1
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max_in_flight[0] == 2
+
+    limiter.backoff(0.1)
+    start = time.monotonic()
+    with limiter:
+        pass
+    assert time.monotonic() - start >= 0.09
+
+
+def test_best_match():
+    candidates = [
+        ('1', 'Daft Punk', 'One More Time', 'Alive 2007'),
+        ('2', 'Daft Punk', 'One More Time', 'Discovery'),
+        ('3', 'Romanthony', 'Hold On', 'Instinctual'),
+    ]
+    assert best_match('Daft Punk - One More Time - Discovery', candidates) == '2'
+    assert best_match('DAFT PUNK - ONE MORE TIME - DISCOVERY', candidates) == '2'
+    assert best_match('Romanthony - Hold On', candidates) == '3'
+    assert best_match('Hold On', [('a', '', 'Hold On', ''), ('b', '', 'Hold On', '')]) == 'a'
+    assert best_match('Nothing Alike', candidates) is None
+    assert best_match('anything', []) is None
+
+
+def test_best_match_without_album():
+    candidates = [
+        ('1', 'Beyoncé, JAY-Z', 'Crazy In Love (feat. Jay-Z)', 'Dangerously In Love'),
+        ('2', 'Daft Punk', 'One More Time', 'Discovery'),
+    ]
+    assert best_match('DAFT PUNK - ONE MORE TIME', candidates, with_album=False) == '2'
+    assert best_match('Beyonce - Crazy In Love', candidates, with_album=False) == '1'
+    assert best_match('Nothing Alike', candidates, with_album=False) is None
+
+
+class FakePlaylistsSpotify:
+    def __init__(self, names):
+        self.playlists = [{'id': str(i), 'name': name} for i, name in enumerate(names)]
+
+    def current_user_playlists(self, limit, offset):
+        items = self.playlists[offset:offset + limit]
+        has_next = offset + limit < len(self.playlists)
+        return {'items': items, 'total': len(self.playlists), 'next': 'next page' if has_next else None}
+
+
+def test_search_user_playlist_by_name():
+    spotify_import = make_spotify_import(FakePlaylistsSpotify(['Mix', 'Chill']))
+    assert spotify_import._search_user_playlist_by_name('Chill')['id'] == '1'
+    assert spotify_import._search_user_playlist_by_name('Nope') is None
+
+    spotify_import.sp = FakePlaylistsSpotify([f'Playlist {i}' for i in range(120)] + ['Mix', 'Mix'])
+    assert spotify_import._search_user_playlist_by_name('Playlist 3')['id'] == '3'
+    assert spotify_import._search_user_playlist_by_name('Mix')['id'] == '120'
+
+    spotify_import.sp = FakePlaylistsSpotify([])
+    assert spotify_import._search_user_playlist_by_name('Mix') is None
+
+
+class FakeSpotify:
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.searches = []
+        self.saved = []
+
+    def search(self, query, limit):
+        self.searches.append(query)
+        if query in self.failing:
+            raise SpotifyException(404, -1, 'not found')
+        track = {'id': f'id:{query.lower()}', 'name': query, 'artists': [{'name': 'Artist'}],
+                 'album': {'name': 'Album'}}
+        return {'tracks': {'items': [track]}}
+
+    def me(self):
+        return {'id': 'user'}
+
+    def user_playlist_create(self, user, name, public):
+        return {'id': 'playlist'}
+
+    def playlist_add_items(self, playlist_id, tracks):
+        self.saved.append(tracks)
+
+    def current_user_saved_tracks_add(self, tracks):
+        self.saved.append(tracks)
+
+
+def make_spotify_import(sp, destination='library', songs='songs.txt', use_cache=False):
+    spotify_import = SpotifyImport(destination, songs, use_cache=use_cache, sp=sp)
+    spotify_import.limiter = RateLimiter(1000, 2)
+    return spotify_import
+
+
+def test_search_many():
+    spotify_import = make_spotify_import(FakeSpotify(failing=('Broken',)))
+    queries = ['One', 'Two', 'one', 'Broken', ' ONE ', 'Three', 'Two'] * 5
+
+    results = list(spotify_import._search_many(queries, limit=1))
+    assert [query for query, _ in results] == queries
+    assert [candidates[0][0] if candidates else None for _, candidates in results] == [
+        'id:one', 'id:two', 'id:one', None, 'id:one', 'id:three', 'id:two'] * 5
+    # Each query is searched once; failures are not cached, so they are retried once per batch of 20.
+    assert sorted(spotify_import.sp.searches) == ['Broken', 'Broken', 'One', 'Three', 'Two']
+    assert sorted(spotify_import._search_cache) == ['1:one', '1:three', '1:two']
+
+    endless_queries = (f'Song {i}' for i in itertools.count())
+    assert [query for query, _ in itertools.islice(spotify_import._search_many(endless_queries), 3)] == [
+        'Song 0', 'Song 1', 'Song 2']
+
+
+class FlakyCall:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return value
+
+
+def test_call_retries():
+    spotify_import = make_spotify_import(FakeSpotify())
+    spotify_import.MAX_BACKOFF = 0
+
+    flaky = FlakyCall(SpotifyException(429, -1, 'slow', headers={'Retry-After': '0'}),
+                      SpotifyException(500, -1, 'oops'),
+                      SpotifyException(429, -1, 'slow', headers={'Retry-After': 'soon'}),
+                      requests.ConnectionError('reset'))
+    assert spotify_import._call(flaky, 'ok') == 'ok'
+    assert flaky.calls == 5
+
+    flaky = FlakyCall(requests.Timeout('timed out'))
+    assert spotify_import._call(flaky, 'ok') == 'ok'
+    assert flaky.calls == 2
+
+    flaky = FlakyCall(SpotifyException(429, -1, 'slow', headers={'Retry-After': '0.1'}))
+    start = time.monotonic()
+    assert spotify_import._call(flaky, 'ok') == 'ok'
+    assert time.monotonic() - start >= 0.09
+
+    flaky = FlakyCall(SpotifyException(404, -1, 'missing'))
+    with pytest.raises(SpotifyException):
+        spotify_import._call(flaky, 'ok')
+    assert flaky.calls == 1
+
+    flaky = FlakyCall(*[SpotifyException(503, -1, 'down')] * spotify_import.MAX_ATTEMPTS)
+    with pytest.raises(SpotifyException):
+        spotify_import._call(flaky, 'ok')
+    assert flaky.calls == spotify_import.MAX_ATTEMPTS
+
+
+def test_call_does_not_retry_non_idempotent_calls_that_may_have_been_applied():
+    spotify_import = make_spotify_import(FakeSpotify())
+    spotify_import.MAX_BACKOFF = 0
+
+    for error in (requests.ReadTimeout('read timed out'), SpotifyException(502, -1, 'bad gateway'),
+                  requests.ConnectionError('connection aborted')):
+        flaky = FlakyCall(error)
+        with pytest.raises(type(error)):
+            spotify_import._call(flaky, 'ok', idempotent=False)
+        assert flaky.calls == 1
+
+    refused = requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'connection refused')))
+    flaky = FlakyCall(SpotifyException(429, -1, 'slow', headers={'Retry-After': '0'}),
+                      requests.ConnectTimeout('connect timed out'), refused)
+    assert spotify_import._call(flaky, 'ok', idempotent=False) == 'ok'
+    assert flaky.calls == 4
+
+
+def test_search_cache_expiry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    now = time.time()
+    ttl = make_spotify_import(FakeSpotify()).SEARCH_CACHE_TTL
+    candidates = [['id', 'Artist', 'Title', 'Album']]
+    (tmp_path / SEARCH_CACHE_FILE).write_bytes(orjson.dumps({
+        '1:fresh': [now - 60, candidates],
+        '1:stale': [now - ttl - 60, candidates],
+        '1:old format': [['1', 'Artist - Title - Album'], ['2', 'Artist - Title - Other Album']],
+        '1:garbage': 'nope',
+    }))
+    assert list(make_spotify_import(FakeSpotify(), use_cache=True)._search_cache) == ['1:fresh']
+
+    (tmp_path / SEARCH_CACHE_FILE).write_bytes(b'[1, 2]')
+    assert make_spotify_import(FakeSpotify(), use_cache=True)._search_cache == {}
+
+
+def test_no_cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'songs.txt').write_text('One\nTwo\n')
+    cache = orjson.dumps({'1:one': [time.time(), [['cached', 'Artist', 'One', 'Album']]]})
+    (tmp_path / SEARCH_CACHE_FILE).write_bytes(cache)
+
+    spotify_import = make_spotify_import(FakeSpotify(), use_cache=False)
+    spotify_import.run()
+    assert spotify_import.sp.searches == ['One', 'Two']
+    assert spotify_import.sp.saved == [['id:one', 'id:two']]
+    assert (tmp_path / SEARCH_CACHE_FILE).read_bytes() == cache
+
+    spotify_import = make_spotify_import(FakeSpotify(), use_cache=True)
+    spotify_import.run()
+    assert spotify_import.sp.searches == ['Two']
+    assert spotify_import.sp.saved == [['cached', 'id:two']]
+    assert sorted(orjson.loads((tmp_path / SEARCH_CACHE_FILE).read_bytes())) == ['1:one', '1:two']
+
+
+def test_duplicate_tracks_are_skipped(tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path)
+    caplog.set_level(logging.INFO, logger='spotify_import')
+    (tmp_path / 'songs.txt').write_text('One\nTwo\none\nOne\n')
+    (tmp_path / 'songs.csv').write_text('artist,title\nArtist,One\nArtist,Two\nArtist,ONE\n')
+
+    spotify_import = make_spotify_import(FakeSpotify(), destination='playlist', songs='songs.txt')
+    spotify_import.run()
+    assert spotify_import.sp.saved == [['id:one', 'id:two']]
+    assert 'Skipped 2 duplicate tracks' in caplog.messages
+
+    caplog.clear()
+    spotify_import = make_spotify_import(FakeSpotify(), destination='playlist', songs='songs.csv')
+    spotify_import.run()
+    assert spotify_import.sp.saved == [['id:artist - one', 'id:artist - two']]
+    assert 'Skipped 1 duplicate tracks' in caplog.messages
+
+
+def test_configure_logging():
+    loggers = [logging.getLogger(), logging.getLogger('spotify_import'), logging.getLogger('spotipy')]
+    levels = [logger.level for logger in loggers]
+    try:
+        configure_logging(verbose=True)
+        assert logging.getLogger('spotify_import').isEnabledFor(logging.DEBUG)
+        assert not logging.getLogger('spotipy.client').isEnabledFor(logging.ERROR)
+        assert not logging.getLogger('urllib3.connectionpool').isEnabledFor(logging.DEBUG)
+
+        configure_logging(verbose=False)
+        assert not logging.getLogger('spotify_import').isEnabledFor(logging.DEBUG)
+        assert logging.getLogger('spotify_import').isEnabledFor(logging.INFO)
+    finally:
+        for logger, level in zip(loggers, levels):
+            logger.setLevel(level)
+
+
+def test_short_csv_rows_are_failed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'songs.csv').write_text('artist,title,album\nArtist,One\nArtist\nArtist,Two,\nLonely\n')
 
+    spotify_import = make_spotify_import(FakeSpotify(), destination='playlist', songs='songs.csv')
+    spotify_import.run()
+    assert spotify_import.sp.searches == ['Artist - One', 'Artist - Two']
+    assert spotify_import.sp.saved == [['id:artist - one', 'id:artist - two']]
+    assert (tmp_path / 'failed.txt').read_text() == 'Artist\nLonely\n'